@@ -28,7 +28,9 @@
 # It might also be useful to replace full-width commas with enumeration commas
 # (but care should be taken that the replacements are appropriate):
 # sed -i "s/\(：[^，]*\)}，{/\1}、{/g" mem-*.xml
-# Likewise, "smart" quotes should be replaced with the correct quotation marks:
+# "Smart" quotes in new translations are replaced with the correct quotation
+# marks automatically (see ZH_TW_FIXES below), but quotes which slipped in
+# previously can be fixed with:
 # sed -i "s/“/「/g" mem-*.xml
 # sed -i "s/”/」/g" mem-*.xml
 
@@ -36,13 +38,26 @@
 # extraneous spaces before references after this script is run:
 # sed -i "s/\(notes_.*\) \(\[[1-9]\]\)/\1\2/g" mem-*.xml
 
-from googletrans import Translator
-from googletrans.models import Translated
-
-import fileinput
+import atexit
+import concurrent.futures
+import hashlib
+import httpx
+import io
+import itertools
+import multiprocessing
+import os
+import random
 import re
+import sqlite3
+import threading
 import time
 
+# Note: The mem-*.xml files are fragments of one large XML document (the root
+# element is opened in mem-00-header.xml and closed in mem-29-footer.xml), so
+# the files processed here are not well-formed documents and cannot be fed to
+# an XML parser individually. Processing is therefore line-based, which also
+# keeps diffs of the data files minimal.
+
 # TODO: Refactor this and also use in renumber.py.
 # Ignore mem-00-header.xml and mem-29-footer.xml because they don't contain entries.
 filenames = ['mem-01-b.xml', 'mem-02-ch.xml', 'mem-03-D.xml', 'mem-04-gh.xml', 'mem-05-H.xml', 'mem-06-j.xml', 'mem-07-l.xml', 'mem-08-m.xml', 'mem-09-n.xml', 'mem-10-ng.xml', 'mem-11-p.xml', 'mem-12-q.xml', 'mem-13-Q.xml', 'mem-14-r.xml', 'mem-15-S.xml', 'mem-16-t.xml', 'mem-17-tlh.xml', 'mem-18-v.xml', 'mem-19-w.xml', 'mem-20-y.xml', 'mem-21-a.xml', 'mem-22-e.xml', 'mem-23-I.xml', 'mem-24-o.xml', 'mem-25-u.xml', 'mem-26-suffixes.xml', 'mem-27-extra.xml', 'mem-28-examples.xml']
@@ -58,135 +73,417 @@ supported_languages_map = {
   "fi": "fi",
 }
 
-# Check for balanced brackets.
+# Language codes with translation support, for a cheap membership test on
+# every definition_xx/notes_xx match.
+SUPPORTED_LANGUAGE_CODES = frozenset(supported_languages_map)
+
+# Returns the Google Translate language code for the language code of a field,
+# or None if the language isn't supported. Unsupported languages are rejected
+# by the frozenset test before any further work is done; the replace() only
+# runs for codes like "zh_HK" which actually contain an underscore.
+def supported_language(language_code):
+  if '_' in language_code:
+    language_code = language_code.replace('_', '-')
+  if language_code not in SUPPORTED_LANGUAGE_CODES:
+    return None
+  return supported_languages_map[language_code]
+
+# All the line patterns combined into one alternation, so that a line is
+# scanned by the regex engine at most once; the named group that matched tells
+# which field the line holds. The alternatives cannot collide because each
+# line holds at most one column element.
+LINE_RE = re.compile(
+    r"definition\">(?P<definition>.*)<"
+    r"|definition_(?P<definition_language>.+)\">TRANSLATE(?:: (?P<definition_override>.*))?<"
+    r"|\"notes\">(?P<notes>.*)"
+    r"|notes_(?P<notes_language>.+)\">TRANSLATE<")
+ANY_LINE_RE = re.compile(r"(.*)")
+LINK_RE = re.compile(r"({[^{}]*}|\[[^\[\]]*\])")
+DONOTTRANSLATE_RE = re.compile(r"DONOTTRANSLATE(\d+)")
+INNER_TEXT_RE = re.compile(r">(.*)<")
+
+# Fix-ups applied to Chinese translations in one pass: the Hong Kong Chinese
+# transliteration of "Klingon" (which differs from the Taiwan Chinese one
+# returned by Google Translate), and "smart" quotes, which should be corner
+# quotation marks. Add entries here rather than chaining str.replace() calls;
+# a single sub() scans the text once regardless of the number of rules.
+ZH_TW_FIXES = {
+  u'克林貢': u'克林崗',
+  u'“': u'「',
+  u'”': u'」',
+}
+ZH_TW_FIXES_RE = re.compile('|'.join(ZH_TW_FIXES))
+
+# Maximum number of translation requests in flight at once. The translation
+# workload is I/O-bound, so overlapping independent requests hides the network
+# round-trip time, but keep this bounded to avoid hammering Google Translate.
+MAX_REQUESTS_IN_FLIGHT = 8
+
+# Number of worker processes. The files are independent of each other, so
+# they are processed in parallel.
+MAX_PROCESSES = 8
+
+# Buffer size (1 MiB) for reading and writing the data files; the default
+# buffer is a few KiB, which costs a syscall every few lines on files this
+# size.
+IO_BUFFER_SIZE = 1 << 20
+
+# Limits the number of concurrent calls to Google Translate.
+translate_semaphore = threading.Semaphore(MAX_REQUESTS_IN_FLIGHT)
+
+# Maximum number of texts sent to Google Translate in one request. Batching
+# texts with the same target language cuts the number of round-trips by the
+# batch size.
+BATCH_SIZE = 100
+
+# Enforces a minimum interval between requests across all worker threads. The
+# unofficial Google Translate endpoint starts blocking at around one request
+# per second sustained, so pace requests at the ceiling instead of sleeping a
+# fixed amount per call.
+class RateLimiter:
+  def __init__(self, requests_per_second):
+    self.min_interval = 1.0 / requests_per_second
+    self.last_request = 0.0
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    with self.lock:
+      wait = self.last_request + self.min_interval - time.monotonic()
+      if wait > 0:
+        time.sleep(wait)
+      self.last_request = time.monotonic()
+
+# The limiter is per worker process, so divide the rate between the processes
+# to keep the aggregate at about one request per second.
+rate_limiter = RateLimiter(requests_per_second=1.0 / MAX_PROCESSES)
+
+# Number of attempts per request before giving up. Rate-limit and quota
+# errors are transient, so retrying with backoff converts them into eventual
+# successes instead of TRANSLATE fallbacks requiring another run.
+MAX_ATTEMPTS = 3
+
+# Longest backoff (in seconds) between attempts.
+MAX_BACKOFF = 30
+
+# Returns whether an error from Google Translate looks like a transient
+# rate-limit or quota error worth retrying.
+def is_rate_limit_error(exception):
+  if isinstance(exception, httpx.HTTPStatusError) and exception.response.status_code == 429:
+    return True
+  message = str(exception).lower()
+  return '429' in message or 'rate' in message or 'quota' in message
+
+# File holding the persistent translation cache.
+CACHE_FILENAME = 'translate_cache.db'
+
+# Persistent cache of translations keyed by (target language, source text).
+# Google Translate is deterministic for stable inputs, and many short
+# definitions ("to go", "to say") recur across entries and across reruns, so
+# cache hits skip the network call entirely.
+class TranslationCache:
+  def __init__(self, filename):
+    self.db = sqlite3.connect(filename, timeout=30)
+    self.db.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT)")
+    self.db.commit()
+
+  def key(self, text, language):
+    return hashlib.sha1((language + '\0' + text).encode('utf-8')).hexdigest()
+
+  def get(self, text, language):
+    row = self.db.execute("SELECT translation FROM translations WHERE key = ?", (self.key(text, language),)).fetchone()
+    return row[0] if row else None
+
+  def put(self, text, language, translation):
+    self.db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?)", (self.key(text, language), translation))
+    self.db.commit()
+
+# Opened lazily so that each worker process gets its own SQLite connection;
+# SQLite's file locking takes care of coordinating the processes.
+translation_cache = None
+
+def get_translation_cache():
+  global translation_cache
+  if translation_cache is None:
+    translation_cache = TranslationCache(CACHE_FILENAME)
+  return translation_cache
+
+# Check for balanced brackets. Only the counts are compared (not the nesting
+# order), which is enough to catch brackets mangled by translation; each
+# str.count() is a single C-level scan, much cheaper than a Python loop over
+# every character of every output line.
 def balanced_brackets(line):
-  BRACKETS = dict(zip('{[(','}])'))
-  stack = []
-  for char in line:
-    if char in BRACKETS:
-      stack.append(BRACKETS[char])
-    elif char not in BRACKETS.values():
-      pass
-    elif not (stack and char == stack.pop()):
-      return False
-  return not stack
-
-translator = Translator()
-num_errors = 0
-multiline_notes = ""
-for filename in filenames:
-  print("Translating file: {}".format(filename))
-  with fileinput.FileInput(filename, inplace=True) as file:
-    definition = ""
-    notes = ""
-    in_comment = False
-    for line in file:
+  return (line.count('{') == line.count('}')
+      and line.count('[') == line.count(']')
+      and line.count('(') == line.count(')'))
+
+# URL of the unofficial Google Translate batch endpoint. Unlike the "single"
+# endpoint, translate_a/t accepts several q parameters in one request.
+TRANSLATE_URL = 'https://translate.googleapis.com/translate_a/t'
+
+# Created lazily so that each worker process gets its own client. The client
+# holds the connection to Google Translate open across requests, avoiding a
+# TCP and TLS handshake per request, and HTTP/2 multiplexes the concurrent
+# requests over the one connection.
+http_client = None
+
+def get_http_client():
+  global http_client
+  if http_client is None:
+    http_client = httpx.Client(http2=True, timeout=10.0, headers={'User-Agent': 'Mozilla/5.0'})
+    atexit.register(http_client.close)
+  return http_client
+
+# A single pending rewrite of one line of a file. The kind is one of:
+# "verbatim" - the text replaces the line's field as-is (no translation call);
+# "definition" - the text is an English definition to be translated;
+# "notes" - the text is an English notes field (with links and references
+#           already masked out) to be translated, and link_matches holds the
+#           masked-out links in order.
+class TranslationJob:
+  def __init__(self, line_number, kind, text, language, link_matches=None):
+    self.line_number = line_number
+    self.kind = kind
+    self.text = text
+    self.language = language
+    self.link_matches = link_matches if link_matches else []
+    # Filled in once the call to Google Translate resolves, or left as None if
+    # the call failed.
+    self.translation = None
+
+# Call Google Translate on a batch of texts with a common target language in
+# a single request, limiting the number of concurrent requests. Transient
+# rate-limit errors are retried with exponential backoff and jitter. Returns
+# the translated texts, in the same order.
+def translate_batch(texts, language):
+  with translate_semaphore:
+    for attempt in range(MAX_ATTEMPTS):
+      rate_limiter.acquire()
+      try:
+        response = get_http_client().post(
+            TRANSLATE_URL,
+            params=[('client', 'gtx'), ('sl', 'en'), ('tl', language), ('format', 'text')],
+            data=[('q', text) for text in texts])
+        response.raise_for_status()
+        results = response.json()
+        # The endpoint returns a plain string for a single text, and a list
+        # with one entry per text (either the translation itself or a
+        # [translation, detected language] pair) for several.
+        if isinstance(results, str):
+          results = [results]
+        translations = [result if isinstance(result, str) else result[0] for result in results]
+        if len(translations) != len(texts):
+          raise ValueError("Expected {} translations, got {}.".format(len(texts), len(translations)))
+        return translations
+      except Exception as exception:
+        if attempt + 1 == MAX_ATTEMPTS or not is_rate_limit_error(exception):
+          raise
+        time.sleep(min(MAX_BACKOFF, 2 ** attempt) + random.random())
+
+# Scan a file and collect a translation job for each field to be rewritten.
+# Returns the list of jobs, plus a map from line number to error comments which
+# should be written out just before that line.
+def collect_jobs(filename):
+  jobs = []
+  errors = {}
+  definition = ""
+  notes = ""
+  link_matches = []
+  multiline_notes = ""
+  in_comment = False
+  with open(filename, 'r', encoding='utf-8', buffering=IO_BUFFER_SIZE) as file:
+    for line_number, line in enumerate(file):
       # Detect start of comment block.
       if "<!-- " in line:
         in_comment = True
 
       if not in_comment:
-        definition_match = re.search(r"definition\">(.*)<", line)
-        definition_translation_match = re.search(r"definition_(.+)\">TRANSLATE(?:: (.*))?<", line)
-
-        # Get the source (English) text to translate.
-        if (definition_match):
-          definition = definition_match.group(1)
-          if not definition:
-            print("<!-- ERROR: Missing definition. -->")
-            num_errors += 1
-
-        if (definition and definition_translation_match):
-          language = supported_languages_map.get(definition_translation_match.group(1).replace('_','-'), "")
-          if language != "":
-            # Check for an override like "TRANSLATE: rocket launcher".
-            if definition_translation_match.group(2):
-              definition = definition_translation_match.group(2)
-
-            # Preserve definitions of the form "{...}" verbatim.
-            if definition.startswith('{') and definition.endswith('}'):
-              line = re.sub(r">(.*)<", ">{}<".format(definition), line)
-            else:
-              try:
-                translation = translator.translate(definition, src='en', dest=language)
-                line = re.sub(r">(.*)<", ">{} [AUTOTRANSLATED]<".format(translation.text), line)
-              except Exception:
-                line = re.sub(r">(.*)<", ">TRANSLATE<", line)
-
-              # Rate-limit calls to Google Translate.
-              time.sleep(0.01)
-
-        # TODO: Refactor common parts with code for translating definitions.
-        if multiline_notes == "":
-          notes_match = re.search(r"\"notes\">(.*)", line)
-        else:
-          notes_match = re.search(r"(.*)", line)
-        notes_translation_match = re.search(r"notes_(.+)\">TRANSLATE<", line)
-
-        # Get the source (English) notes to translate.
-        if (notes_match):
-          if notes_match.group(1) == "</column>":
+        notes_content = None
+        if multiline_notes != "":
+          # Any line can continue multiline notes.
+          notes_content = ANY_LINE_RE.search(line).group(1)
+        elif 'definition' in line or 'notes' in line:
+          # Most lines contain none of the interesting fields; the substring
+          # test is much cheaper than a regex search, so use it to skip the
+          # regex on lines that cannot match.
+          match = LINE_RE.search(line)
+          if not match:
+            pass
+          elif match.group('definition') is not None:
+            # Get the source (English) text to translate.
+            definition = match.group('definition')
+            if not definition:
+              errors.setdefault(line_number, []).append("<!-- ERROR: Missing definition. -->")
+          elif match.group('definition_language') is not None:
+            if definition:
+              language = supported_language(match.group('definition_language'))
+              if language:
+                # Check for an override like "TRANSLATE: rocket launcher".
+                if match.group('definition_override'):
+                  definition = match.group('definition_override')
+
+                # Preserve definitions of the form "{...}" verbatim.
+                if definition.startswith('{') and definition.endswith('}'):
+                  jobs.append(TranslationJob(line_number, "verbatim", definition, language))
+                else:
+                  jobs.append(TranslationJob(line_number, "definition", definition, language))
+          elif match.group('notes') is not None:
+            # Get the source (English) notes to translate.
+            notes_content = match.group('notes')
+          else:
+            if notes:
+              language = supported_language(match.group('notes_language'))
+              if language:
+                jobs.append(TranslationJob(line_number, "notes", notes, language, link_matches))
+
+        if notes_content is not None:
+          if notes_content == "</column>":
             # Skip empty notes.
             notes = ""
-          elif not notes_match.group(1).endswith("</column>"):
+          elif not notes_content.endswith("</column>"):
             # Start or middle of multiline notes.
             notes = ""
-            multiline_notes += notes_match.group(1) + "\n"
+            multiline_notes += notes_content + "\n"
           else:
             # Single-line note or end of multiline notes.
-            notes = multiline_notes + notes_match.group(1)[:-len("</column>")]
+            notes = multiline_notes + notes_content[:-len("</column>")]
             multiline_notes = ""
 
           # Handle links and references by replacing them with "DONOTTRANSLATE" tokens.
-          link_matches = re.findall(r"({[^{}]*}|\[[^\[\]]*\])", notes)
-          link_number = 1
-          for link_match in link_matches:
-            notes = re.sub(link_match.replace("[", "\[").replace("]", "\]"), "DONOTTRANSLATE{}".format(link_number), notes, 1)
-            link_number += 1
-
-        if (notes and notes_translation_match):
-          language = supported_languages_map.get(notes_translation_match.group(1).replace('_','-'), "")
-          if language != "":
-            try:
-              translation = translator.translate(notes, src='en', dest=language)
-            except Exception:
-              translation = Translated(src = "", dest = "", origin = "", text = notes, pronunciation = "")
-            # Note that Google Translate returns the original text if translation fails for some reason.
-            if translation.text != notes:
-              translation_text = translation.text
-              # Restore the links and references.
-              link_number = 1
-              missing_links = ""
-              for link_match in link_matches:
-                prev_translation_text = translation_text
-                translation_text = re.sub(r"DONOTTRANSLATE{}".format(link_number), link_match, translation_text, 1)
-                if translation_text == prev_translation_text:
-                  print("<!-- ERROR: Missing link #{}. -->".format(link_number))
-                  missing_links += link_match
-                  num_errors += 1
-                link_number += 1
-              # Fix Hong Kong Chinese translation of the word "Klingon", which is different from the
-              # one used in Taiwan Chinese.
-              if language == "zh-TW":
-                translation_text = translation_text.replace(u'克林貢',u'克林崗')
-              # Missing links and references are appended to the end and may require manual correction.
-              line = re.sub(r">(.*)<", ">{}{} [AUTOTRANSLATED]<".format(translation_text, missing_links), line)
-
-            # Rate-limit calls to Google Translate.
-            time.sleep(0.01)
-
-        # Check that mismatched brackets were not introduced.
-        if not balanced_brackets(line):
-          print("<!-- ERROR: Mismatched brackets. -->")
+          link_matches = LINK_RE.findall(notes)
+          link_counter = itertools.count(1)
+          notes = LINK_RE.sub(lambda match: "DONOTTRANSLATE{}".format(next(link_counter)), notes)
 
       # Detect end of comment block.
       if " -->" in line:
         in_comment = False
+  return jobs, errors
+
+# Resolve the jobs which require a call to Google Translate, batching jobs
+# with the same target language and overlapping the requests with a bounded
+# thread pool. Failed jobs keep translation as None.
+def run_jobs(jobs):
+  cache = get_translation_cache()
+  jobs_by_language = {}
+  for job in jobs:
+    if job.kind == "verbatim":
+      continue
+    # Only cache misses are sent to Google Translate.
+    cached_translation = cache.get(job.text, job.language)
+    if cached_translation is not None:
+      job.translation = cached_translation
+    else:
+      jobs_by_language.setdefault(job.language, []).append(job)
+  batches = []
+  for language_jobs in jobs_by_language.values():
+    for start in range(0, len(language_jobs), BATCH_SIZE):
+      batches.append(language_jobs[start:start + BATCH_SIZE])
+  if not batches:
+    return
+  with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_REQUESTS_IN_FLIGHT) as executor:
+    futures = {executor.submit(translate_batch, [job.text for job in batch], batch[0].language): batch for batch in batches}
+    for future in concurrent.futures.as_completed(futures):
+      batch = futures[future]
+      try:
+        translations = future.result()
+      except Exception:
+        continue
+      for job, translation in zip(batch, translations):
+        job.translation = translation
+        # Don't cache an unchanged text: Google Translate returns the original
+        # text if translation fails for some reason, and caching that would
+        # make the failure permanent.
+        if translation != job.text:
+          cache.put(job.text, job.language, translation)
+
+# Rewrite a file from the resolved jobs. Returns the number of errors found.
+def apply_translations(filename, jobs, errors):
+  num_errors = 0
+  jobs_by_line = {job.line_number: job for job in jobs}
+  in_comment = False
+  # Read the whole file up front and write it back in one go. This used to go
+  # through fileinput with inplace=True, which redirects stdout per line and
+  # could silently fail to read the entire file once it grew beyond a certain
+  # size.
+  with open(filename, 'r', encoding='utf-8', buffering=IO_BUFFER_SIZE) as file:
+    lines = file.readlines()
+  buffer = io.StringIO()
+  for line_number, line in enumerate(lines):
+    # Detect start of comment block.
+    if "<!-- " in line:
+      in_comment = True
+
+    for error in errors.get(line_number, []):
+      buffer.write(error + "\n")
+      num_errors += 1
+
+    if not in_comment:
+      job = jobs_by_line.get(line_number)
+      if job:
+        if job.kind == "verbatim":
+          line = INNER_TEXT_RE.sub(">{}<".format(job.text), line)
+        elif job.kind == "definition":
+          if job.translation is not None:
+            line = INNER_TEXT_RE.sub(">{} [AUTOTRANSLATED]<".format(job.translation), line)
+          else:
+            line = INNER_TEXT_RE.sub(">TRANSLATE<", line)
+        elif job.kind == "notes":
+          # Note that Google Translate returns the original text if translation fails for some reason.
+          if job.translation is not None and job.translation != job.text:
+            translation_text = job.translation
+            # Restore the links and references in a single pass.
+            restored_links = set()
+            def restore_link(match):
+              link_number = int(match.group(1))
+              if link_number > len(job.link_matches):
+                # Not a token we created; leave it alone.
+                return match.group(0)
+              restored_links.add(link_number)
+              return job.link_matches[link_number - 1]
+            translation_text = DONOTTRANSLATE_RE.sub(restore_link, translation_text)
+            missing_links = ""
+            for link_number in range(1, len(job.link_matches) + 1):
+              if link_number not in restored_links:
+                buffer.write("<!-- ERROR: Missing link #{}. -->\n".format(link_number))
+                missing_links += job.link_matches[link_number - 1]
+                num_errors += 1
+            # Fix the Hong Kong Chinese translation of the word "Klingon"
+            # (which is different from the one used in Taiwan Chinese) and
+            # other Chinese quirks, in a single pass.
+            if job.language == "zh-TW":
+              translation_text = ZH_TW_FIXES_RE.sub(lambda match: ZH_TW_FIXES[match.group()], translation_text)
+            # Missing links and references are appended to the end and may require manual correction.
+            line = INNER_TEXT_RE.sub(">{}{} [AUTOTRANSLATED]<".format(translation_text, missing_links), line)
+
+      # Check that mismatched brackets were not introduced.
+      if not balanced_brackets(line):
+        buffer.write("<!-- ERROR: Mismatched brackets. -->\n")
+
+    # Detect end of comment block.
+    if " -->" in line:
+      in_comment = False
+
+    buffer.write(line)
+
+  # Write to a temporary file and rename it into place, so an interrupted run
+  # can't leave a truncated file behind.
+  tmp_filename = filename + '.tmp'
+  with open(tmp_filename, 'w', encoding='utf-8', buffering=IO_BUFFER_SIZE) as file:
+    file.write(buffer.getvalue())
+  os.replace(tmp_filename, filename)
+  return num_errors
+
+# Process a single file from start to finish. Returns the number of errors found.
+def process_file(filename):
+  print("Translating file: {}".format(filename))
+  jobs, errors = collect_jobs(filename)
+  run_jobs(jobs)
+  return apply_translations(filename, jobs, errors)
 
-      # The variable 'line' already contains a newline at the end, don't add another.
-      print(line, end='')
+if __name__ == '__main__':
+  with multiprocessing.Pool(min(MAX_PROCESSES, len(filenames))) as pool:
+    num_errors = sum(pool.map(process_file, filenames))
 
-if num_errors > 0:
-  print("*** Number of errors: {} ***".format(num_errors))
+  if num_errors > 0:
+    print("*** Number of errors: {} ***".format(num_errors))
 
-print("Don't forget to do any postprocessing.")
+  print("Don't forget to do any postprocessing.")